@@ -29,10 +29,15 @@
 
 import argparse
 import logging
+import logging.handlers
 
 from .server import SERVER
 
-logging.basicConfig(filename="pygls.log", level=logging.DEBUG, filemode="w")
+# Number of log records which are written to the log file at once
+LOG_BUFFER_CAPACITY = 1024
+
+# Maximal size of the log file before it is rotated
+LOG_MAX_BYTES = 10 * 1024 * 1024
 
 
 def add_arguments(parser):
@@ -54,12 +59,45 @@ def add_arguments(parser):
         "--port", type=int, default=2087,
         help="Bind to this port"
     )
+    parser.add_argument(
+        "--log-file",
+        help="Write the log to this file"
+    )
+    parser.add_argument(
+        "--log-level", default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Log messages of at least this level"
+    )
+
+
+def setup_logging(log_file, log_level):
+    """
+    Log to stderr or, if given, to `log_file`.
+
+    Records for the log file are buffered and written in batches, unless
+    an error is logged. The log file is appended to and rotated once it
+    exceeds `LOG_MAX_BYTES`.
+    """
+    if log_file is None:
+        logging.basicConfig(level=log_level)
+        return
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=1, delay=True
+    )
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=log_level, handlers=[
+        logging.handlers.MemoryHandler(
+            LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR,
+            target=file_handler
+        )
+    ])
 
 
 def main():
     parser = argparse.ArgumentParser()
     add_arguments(parser)
     args = parser.parse_args()
+    setup_logging(args.log_file, args.log_level)
 
     if args.tcp:
         SERVER.start_tcp(args.host, args.port)
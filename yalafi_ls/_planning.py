@@ -0,0 +1,417 @@
+#
+#   YaLafi LSP server
+#   Copyright (C) 2023 torik42 (at GitHub)
+#
+#   This file is part of YaLafi-LS.
+#
+#   YaLafi-LS is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see https://www.gnu.org/licenses.
+#
+
+"""
+Planning of the spellchecks of changed paragraphs.
+
+A plan tells which paragraphs of a document are passed to YaLafi and which
+results are taken from the cache of matches of unchanged paragraphs.
+"""
+
+import bisect
+import difflib
+import hashlib
+import itertools
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional, List, Tuple
+
+from ._pool import YALAFI_WORKERS
+
+# Maximal number of paragraphs whose matches are cached
+MATCH_CACHE_SIZE = 4096
+
+# Minimal number of characters checked by each worker in parallel
+MIN_JOB_LENGTH = 20000
+
+_BEGIN_DOCUMENT = re.compile(r'^[^%\n]*\\begin\s*\{document\}')
+_ENVIRONMENT = re.compile(r'\\(begin|end)\s*\{(?!document\})')
+# A `%` starts a comment unless it is escaped by a backslash.
+_COMMENT = re.compile(r'(?<!\\)((?:\\\\)*)%.*')
+# Macros which YaLafi uses to define macros or to load definitions
+_DEFINITION = re.compile(
+    r'^[^%\n]*\\(?:(?:re)?newcommand|providecommand|def|newtheorem|LTinput)'
+    r'(?![a-zA-Z])',
+    re.MULTILINE
+)
+
+
+class MatchCache:
+    """
+    The matches of checked paragraphs, of which at most `size` are kept.
+
+    The paragraphs used least recently are dropped first.
+    """
+
+    def __init__(self, size=MATCH_CACHE_SIZE):
+        self.size = size
+        self.matches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached matches of `key` or None."""
+        with self.lock:
+            matches = self.matches.get(key)
+            if matches is not None:
+                self.matches.move_to_end(key)
+            return matches
+
+    def store(self, matches, pending):
+        """
+        Store the matches of the offset ranges in `pending`.
+
+        The offsets of the stored matches are relative to the start of their
+        range.
+        """
+        matches = sorted(matches, key=lambda match: match['offset'])
+        match_offsets = [match['offset'] for match in matches]
+        with self.lock:
+            for start, end, key in pending:
+                self.matches[key] = [
+                    dict(match, offset=match['offset'] - start)
+                    for match in matches[
+                        bisect.bisect_left(match_offsets, start):
+                        bisect.bisect_left(match_offsets, end)
+                    ]
+                ]
+            while len(self.matches) > self.size:
+                self.matches.popitem(last=False)
+
+
+class SpellcheckPlan(NamedTuple):
+    """
+    Describes which parts of a document are passed to YaLafi.
+
+    changed: The line ranges whose diagnostics are replaced or None if all
+        diagnostics are replaced.
+    matches: The cached matches of paragraphs which are not checked.
+    jobs: Tuples `(check_source, checked)` for each run of YaLafi, where
+        `check_source` is passed to YaLafi and `checked` are the offset
+        ranges of the text whose matches are used.
+    pending: Tuples `(start, end, key)` of offset ranges whose matches are
+        stored in the cache under `key`.
+    """
+    changed: Optional[List[Tuple[int, int]]]
+    matches: List[dict]
+    jobs: List[Tuple[str, List[Tuple[int, int]]]]
+    pending: List[Tuple[int, int, tuple]]
+
+
+def plan_spellcheck(cache, old_source, new_source, context):
+    """
+    Prepare the source which is passed to YaLafi.
+
+    If `old_source` was checked before and the preamble did not change, only
+    the changed paragraphs are checked, otherwise the full document. Of these,
+    paragraphs found in `cache` are not checked either. Lines which are not
+    checked are replaced by spaces, such that offsets of the remaining text
+    do not change. The preamble and paragraphs defining macros are always
+    kept. If any of them changed, the full document is checked.
+
+    The cache keys contain the hash of the kept text and `context`.
+    """
+    if old_source == new_source:
+        return SpellcheckPlan([], [], [], [])
+    lines = _split_lines(new_source)
+    offsets = [0, *itertools.accumulate(map(len, lines))]
+    preamble = _preamble_length(lines)
+    definitions = _definition_paragraphs(new_source, lines, offsets, preamble)
+    definitions_text = ''.join(''.join(lines[start:end])
+                               for start, end in definitions)
+    changed = _changed_ranges(old_source, lines, preamble, definitions_text)
+    if changed is None:
+        units = [(0, preamble)] if preamble > 0 else []
+        units.extend(_paragraphs(lines, [(preamble, len(lines))]))
+    else:
+        units = list(_paragraphs(lines, changed))
+    context = (
+        hashlib.blake2b(
+            (''.join(lines[:preamble]) + definitions_text).encode()
+        ).digest(),
+        *context
+    )
+    checked, matches, pending = _lookup_paragraphs(cache, lines, offsets,
+                                                   units, context)
+    jobs = [
+        _create_job(lines, offsets, [(0, preamble), *definitions], group)
+        for group in _split_paragraphs(checked, offsets)
+    ]
+    return SpellcheckPlan(changed, matches, jobs, pending)
+
+
+def _lookup_paragraphs(cache, lines, offsets, units, context):
+    """
+    Look up the matches of the line ranges `units` in `cache`.
+
+    Returns:
+        A tuple `(checked, matches, pending)` as in `_split_paragraphs` and
+        `SpellcheckPlan`.
+    """
+    matches = []
+    checked = []
+    pending = []
+    # Changed ranges start outside of environments, so the depth of each
+    # unit is the sum of the balances of the units before.
+    depth = 0
+    for start, end in units:
+        text = ''.join(lines[start:end])
+        balance = _environment_balance(text)
+        if depth != 0 or balance != 0:
+            # Results depend on the surrounding text and cannot be cached.
+            checked.append((start, end, balance))
+            depth += balance
+            continue
+        key = (hashlib.blake2b(text.encode()).digest(), context)
+        cached = cache.get(key)
+        if cached is None:
+            checked.append((start, end, 0))
+            pending.append((offsets[start], offsets[end], key))
+        else:
+            matches.extend(dict(match, offset=match['offset'] + offsets[start])
+                           for match in cached)
+    return checked, matches, pending
+
+
+def _create_job(lines, offsets, kept, group):
+    """
+    Return the job checking the paragraphs in `group`.
+
+    The line ranges in `kept` are kept in addition to the paragraphs.
+    """
+    keep = [False] * len(lines)
+    for start, end in kept:
+        keep[start:end] = [True] * (end - start)
+    for start, end, _ in group:
+        keep[start:end] = [True] * (end - start)
+    return (
+        ''.join(line if line_kept else _blank_line(line)
+                for line, line_kept in zip(lines, keep)),
+        [(offsets[start], offsets[end]) for start, end, _ in group]
+    )
+
+
+def _split_paragraphs(paragraphs, offsets):
+    """
+    Split the paragraphs into groups, which are checked in parallel.
+
+    The number of groups is at most `YALAFI_WORKERS` and each group contains
+    about `MIN_JOB_LENGTH` characters or more. Groups are only split where
+    all environments are closed.
+
+    Args:
+        paragraphs: Tuples `(start, end, balance)` of line ranges and the
+            difference of the numbers of `\\begin` and `\\end` therein.
+        offsets: The offsets of the line starts.
+    """
+    if not paragraphs:
+        return []
+    length = sum(offsets[end] - offsets[start] for start, end, _ in paragraphs)
+    count = min(YALAFI_WORKERS, length // MIN_JOB_LENGTH)
+    if count <= 1:
+        return [paragraphs]
+    groups = [[]]
+    group_length = 0
+    depth = 0
+    for paragraph in paragraphs:
+        start, end, balance = paragraph
+        groups[-1].append(paragraph)
+        group_length += offsets[end] - offsets[start]
+        depth += balance
+        if (depth == 0 and group_length >= length / count
+                and len(groups) < count):
+            groups.append([])
+            group_length = 0
+    if not groups[-1]:
+        groups.pop()
+    return groups
+
+
+def _changed_ranges(old_source, new_lines, preamble, definitions_text):
+    """
+    Return the line ranges of paragraphs which changed since `old_source`.
+
+    Returns None if the full document has to be checked.
+    """
+    if old_source is None:
+        return None
+    old_lines = _split_lines(old_source)
+    if old_lines[:preamble] != new_lines[:preamble]:
+        return None
+    old_offsets = [0, *itertools.accumulate(map(len, old_lines))]
+    old_definitions = _definition_paragraphs(old_source, old_lines,
+                                             old_offsets, preamble)
+    if definitions_text != ''.join(''.join(old_lines[start:end])
+                                   for start, end in old_definitions):
+        return None
+    changed = _changed_paragraphs(old_lines, new_lines, preamble)
+    if changed and changed[0][0] < preamble:
+        return None
+    depth = 0
+    previous_end = preamble
+    for start, end in changed:
+        depth += _environment_balance(''.join(new_lines[previous_end:start]))
+        if (depth != 0
+                or _environment_balance(''.join(new_lines[start:end])) != 0):
+            # The changes are part of an environment, which has to be
+            # checked as a whole.
+            return None
+        previous_end = end
+    return changed
+
+
+def _paragraphs(lines, ranges):
+    """Split the line ranges into paragraphs separated by blank lines."""
+    for start, end in ranges:
+        paragraph_start = None
+        for i in range(start, end):
+            if lines[i].strip():
+                if paragraph_start is None:
+                    paragraph_start = i
+            elif paragraph_start is not None:
+                yield paragraph_start, i
+                paragraph_start = None
+        if paragraph_start is not None:
+            yield paragraph_start, end
+
+
+def in_ranges(offset, ranges):
+    """Return whether `offset` lies in one of the sorted offset `ranges`."""
+    index = bisect.bisect_right(ranges, (offset, math.inf)) - 1
+    return index >= 0 and offset < ranges[index][1]
+
+
+def _preamble_length(lines):
+    """Return the number of lines up to and including `\\begin{document}`."""
+    for i, line in enumerate(lines):
+        if _BEGIN_DOCUMENT.match(line):
+            return i + 1
+    return 0
+
+
+def _definition_paragraphs(tex, lines, offsets, preamble):
+    """
+    Return the line ranges of the paragraphs after the preamble which
+    define macros.
+
+    Args:
+        tex: The text consisting of `lines`.
+        offsets: The offsets of the line starts.
+    """
+    ranges = []
+    for match in _DEFINITION.finditer(tex, offsets[preamble]):
+        line = bisect.bisect_right(offsets, match.start()) - 1
+        if ranges and line < ranges[-1][1]:
+            continue
+        start = line
+        while start > preamble and lines[start-1].strip():
+            start -= 1
+        end = line + 1
+        while end < len(lines) and lines[end].strip():
+            end += 1
+        ranges.append((start, end))
+    return ranges
+
+
+def _environment_balance(tex):
+    """
+    Return the number of `\\begin{...}` minus that of `\\end{...}`.
+
+    Comments are ignored.
+    """
+    if '%' in tex:
+        tex = _COMMENT.sub(r'\1', tex)
+    count = 0
+    for match in _ENVIRONMENT.finditer(tex):
+        count += 1 if match.group(1) == 'begin' else -1
+    return count
+
+
+def _split_lines(tex):
+    """
+    Split `tex` into lines, which keep their line breaks.
+
+    Unlike `str.splitlines`, this only splits at `\n`, as do the positions
+    of the LSP.
+    """
+    lines = [line + '\n' for line in tex.split('\n')]
+    last = lines.pop()[:-1]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _blank_line(line):
+    content = line.rstrip('\r\n')
+    return ' ' * len(content) + line[len(content):]
+
+
+def _changed_paragraphs(old_lines, new_lines, first=0):
+    """
+    Find the paragraphs in `new_lines` which differ from `old_lines`.
+
+    Paragraphs are separated by blank lines and do not extend above the
+    line `first`.
+
+    Returns:
+        A sorted list of disjoint line ranges `(start, end)`, where `end` is
+        exclusive.
+    """
+    blank = [not line.strip() for line in new_lines]
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines,
+                                      autojunk=False)
+    changed = []
+    for tag, _, _, start, end in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        while start > first and not blank[start-1]:
+            start -= 1
+        while end < len(new_lines) and not blank[end]:
+            end += 1
+        if changed and start <= changed[-1][1]:
+            changed[-1] = (changed[-1][0], max(end, changed[-1][1]))
+        else:
+            changed.append((start, end))
+    return changed
+
+
+def merge_diagnostics(old_diagnostics, new_diagnostics, changed):
+    """
+    Replace the diagnostics of changed line ranges.
+
+    Diagnostics from `old_diagnostics` are dropped if they intersect a changed
+    line range and only those from `new_diagnostics` are used which start in
+    a changed line range.
+    """
+    def in_changed(diag):
+        return any(diag.range.start.line < end and start <= diag.range.end.line
+                   for start, end in changed)
+    diagnostics = [d for d in old_diagnostics if not in_changed(d)]
+    diagnostics.extend(
+        d for d in new_diagnostics
+        if any(start <= d.range.start.line < end for start, end in changed)
+    )
+    diagnostics.sort(key=_diagnostic_start)
+    return diagnostics
+
+
+def _diagnostic_start(diag):
+    return (diag.range.start.line, diag.range.start.character)
@@ -0,0 +1,271 @@
+#
+#   YaLafi LSP server
+#   Copyright (C) 2023 torik42 (at GitHub)
+#
+#   This file is part of YaLafi-LS.
+#
+#   YaLafi-LS is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see https://www.gnu.org/licenses.
+#
+
+"""
+Pool of the persistent worker processes running YaLafi.
+
+The workers run `yalafi_ls._worker`. Each spellcheck registers an entry
+under its progress token, which holds the workers busy with its jobs, such
+that these can be killed if the spellcheck is cancelled.
+"""
+
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+from dataclasses import dataclass, field
+from typing import Set
+
+# Number of YaLafi worker processes
+YALAFI_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+
+
+@dataclass
+class SubprocessEntry:
+    """
+    The worker processes running YaLafi for a spellcheck of `uri`.
+
+    Once `cancelled` is set, no further worker may be added.
+    """
+    uri: str
+    processes: Set[subprocess.Popen] = field(default_factory=set)
+    cancelled: bool = False
+
+
+def start_worker():
+    """Start a worker process, which imports YaLafi right away."""
+    return subprocess.Popen(
+        [sys.executable, '-m', 'yalafi_ls._worker'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+
+
+class WorkerPool:
+    """
+    At most `size` workers, which are started when they are needed first.
+    """
+
+    def __init__(self, size=YALAFI_WORKERS):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.count = 0
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.entries_lock = threading.Lock()
+        self.closed = False
+
+    def acquire(self):
+        """
+        Take an idle worker from the pool.
+
+        A new worker is started if no worker is idle and there are less than
+        `size` workers. Otherwise, this waits for an idle worker. Workers
+        which terminated, for instance because a spellcheck was cancelled,
+        are restarted. Returns None once the pool was shut down.
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            start_new = self.idle.empty() and self.count < self.size
+            if start_new:
+                self.count += 1
+        worker = None if start_new else self.idle.get()
+        if self.closed:
+            if not start_new:
+                # Wake the next thread waiting for a worker.
+                self.idle.put(worker)
+            return None
+        if worker is None or worker.poll() is not None:
+            try:
+                worker = start_worker()
+            except OSError:
+                with self.lock:
+                    self.count -= 1
+                raise
+        return worker
+
+    def release(self, worker):
+        """
+        Return a worker to the pool.
+
+        A worker which terminated, for instance because a spellcheck was
+        cancelled, is replaced right away. Thus, the new worker has already
+        imported YaLafi when the next spellcheck starts. Once the pool was
+        shut down, the worker is killed instead.
+        """
+        if worker.poll() is not None and not self.closed:
+            try:
+                worker = start_worker()
+            except OSError:
+                # `acquire` tries again.
+                pass
+        with self.lock:
+            closed = self.closed
+            if closed:
+                worker.kill()
+            self.idle.put(worker)
+        if closed:
+            worker.wait()
+
+    def register(self, token, uri):
+        """
+        Register a spellcheck of `uri` with the progress `token`.
+
+        Once the pool was shut down, the spellcheck is cancelled right away.
+        """
+        with self.entries_lock:
+            entry = SubprocessEntry(uri, cancelled=self.closed)
+            self.entries[token] = entry
+        return entry
+
+    def unregister(self, token):
+        """Remove the entry of the progress `token`."""
+        with self.entries_lock:
+            del self.entries[token]
+
+    def cancel(self, token):
+        """
+        Kill the workers of the spellcheck with the progress `token`.
+
+        Returns whether the spellcheck was running and not cancelled before.
+        """
+        with self.entries_lock:
+            entry = self.entries.get(token)
+            return entry is not None and _cancel_entry(entry)
+
+    def cancel_document(self, uri):
+        """
+        Kill the workers of all spellchecks of `uri`.
+
+        Returns whether any of them was not cancelled before.
+        """
+        with self.entries_lock:
+            cancelled = [_cancel_entry(entry)
+                         for entry in self.entries.values()
+                         if entry.uri == uri]
+        return any(cancelled)
+
+    def shutdown(self):
+        """
+        Cancel all spellchecks, kill all workers and wait until they
+        terminated.
+        """
+        workers = []
+        with self.lock:
+            self.closed = True
+            while not self.idle.empty():
+                worker = self.idle.get_nowait()
+                if worker is not None:
+                    workers.append(worker)
+        with self.entries_lock:
+            for entry in self.entries.values():
+                _cancel_entry(entry)
+                workers.extend(entry.processes)
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+        # Wake the threads waiting for an idle worker.
+        self.idle.put(None)
+
+    def run(self, token, args, cwd):
+        """
+        Run `yalafi.shell` in a worker process.
+
+        While YaLafi runs, the worker is registered in the entry of the
+        progress `token`.
+
+        Returns:
+            A tuple `(stdout, stderr)` of the output of YaLafi, where
+            `stdout` are the bytes written by YaLafi.
+
+        Raises:
+            subprocess.CalledProcessError: If YaLafi or the worker failed.
+        """
+        cmd = [sys.executable, '-m', 'yalafi.shell'] + args
+        worker = self.acquire()
+        if worker is None:
+            raise subprocess.CalledProcessError(
+                1, cmd, stderr='The YaLafi workers were shut down.'
+            )
+        try:
+            with self.entries_lock:
+                entry = self.entries[token]
+                if entry.cancelled:
+                    raise subprocess.CalledProcessError(
+                        1, cmd, stderr='The spellcheck was cancelled.'
+                    )
+                entry.processes.add(worker)
+            try:
+                reply = _run_job(worker, args, cwd)
+            finally:
+                with self.entries_lock:
+                    entry.processes.discard(worker)
+            if reply is None:
+                # The worker cannot be used for further jobs.
+                worker.kill()
+                raise subprocess.CalledProcessError(
+                    worker.wait(), cmd,
+                    stderr='The YaLafi worker terminated or sent an invalid '
+                           'reply.'
+                )
+        finally:
+            self.release(worker)
+        stdout, returncode, stderr = reply
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, cmd,
+                stdout.decode('UTF-8', errors='replace'), stderr
+            )
+        return stdout, stderr
+
+
+def _cancel_entry(entry):
+    """Kill the workers of a spellcheck. Call with the lock of the entries."""
+    if entry.cancelled:
+        return False
+    entry.cancelled = True
+    for worker in entry.processes:
+        worker.kill()
+    return True
+
+
+def _run_job(worker, args, cwd):
+    """
+    Send a job to `worker` and read its reply.
+
+    Returns a tuple `(stdout, returncode, stderr)` or None if the worker
+    terminated or its reply is broken.
+    """
+    try:
+        job = json.dumps({'args': args, 'cwd': str(cwd)}) + '\n'
+        worker.stdin.write(job.encode('UTF-8'))
+        worker.stdin.flush()
+        header = worker.stdout.readline()
+        if not header:
+            return None
+        reply = json.loads(header)
+        stdout = worker.stdout.read(reply['length'])
+        if len(stdout) < reply['length']:
+            return None
+        return stdout, reply['returncode'], reply['stderr']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
@@ -0,0 +1,131 @@
+#
+#   YaLafi LSP server
+#   Copyright (C) 2023 torik42 (at GitHub)
+#
+#   This file is part of YaLafi-LS.
+#
+#   YaLafi-LS is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see https://www.gnu.org/licenses.
+#
+
+"""
+Persistent worker process running YaLafi.
+
+The worker reads one job per line from stdin. A job is a JSON object with
+the keys `args`, the command line arguments for `yalafi.shell`, and `cwd`,
+the working directory. For each job, `yalafi.shell` is run inside the worker
+and a JSON object with the keys `returncode`, `stderr` and `length` is
+written as a single line to stdout. It is followed by the `length` bytes
+which YaLafi wrote to stdout, such that they need not be decoded and
+escaped.
+
+Since the worker keeps running, YaLafi is only imported once. This happens
+when the worker starts, such that the first job does not wait for it.
+"""
+
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+SHELL_SPEC = importlib.util.find_spec('yalafi.shell.shell')
+SHELL_CODE = SHELL_SPEC.loader.get_code(SHELL_SPEC.name)
+
+# Modules imported by `yalafi.shell` for the JSON output
+PRELOAD_MODULES = ('yalafi.tex2txt', 'yalafi.shell.proofreader',
+                   'yalafi.shell.genjson')
+
+
+def run_job(args, cwd):
+    """
+    Run `yalafi.shell` with the command line arguments `args` in `cwd`.
+
+    `yalafi.shell` writes its report directly to the file descriptor of
+    stdout. Hence, both stdout and stderr are redirected to temporary files
+    while YaLafi runs.
+
+    The modules imported by `yalafi.shell` keep their state between jobs.
+    The proofreader remembers that the local LanguageTool server of
+    `--server my` is running, so this is reset in case the server stopped.
+    """
+    namespace = {
+        '__name__': '__main__',
+        '__file__': SHELL_SPEC.origin,
+        '__package__': SHELL_SPEC.parent,
+        '__spec__': SHELL_SPEC,
+    }
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    saved_fds = (os.dup(1), os.dup(2))
+    returncode = 0
+    proofreader = importlib.import_module('yalafi.shell.proofreader')
+    proofreader.ltserver_local_running = False
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        try:
+            os.chdir(cwd)
+            sys.argv = ['yalafi.shell'] + args
+            exec(SHELL_CODE, namespace)  # pylint: disable=exec-used
+        except SystemExit as exception:
+            if isinstance(exception.code, int):
+                returncode = exception.code
+            elif exception.code is not None:
+                returncode = 1
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # YaLafi opened its own file object on the file descriptor of
+            # stdout. It has to be closed before stdout is restored.
+            if 'out_utf8' in namespace:
+                namespace['out_utf8'].close()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            sys.argv = saved_argv
+            os.chdir(saved_cwd)
+        out.seek(0)
+        err.seek(0)
+        return {
+            'returncode': returncode,
+            'stdout': out.read(),
+            'stderr': err.read().decode('UTF-8', errors='replace'),
+        }
+
+
+def main():
+    """Run the jobs read from stdin and write each reply to stdout."""
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+    channel = os.fdopen(os.dup(1), 'wb')
+    # Anything else written to stdout must not end up in the channel.
+    os.dup2(2, 1)
+    for line in sys.stdin:
+        job = json.loads(line)
+        reply = run_job(job['args'], job['cwd'])
+        stdout = reply.pop('stdout')
+        reply['length'] = len(stdout)
+        channel.write(json.dumps(reply).encode('UTF-8') + b'\n')
+        channel.write(stdout)
+        channel.flush()
+
+
+if __name__ == '__main__':
+    main()
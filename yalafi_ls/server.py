@@ -18,22 +18,36 @@
 #   along with this program.  If not, see https://www.gnu.org/licenses.
 #
 
+import asyncio
+import bisect
+import itertools
 import json
+import math
+import operator
+import os
+import re
 import sys
 import subprocess
+import tempfile
+import threading
+import time
 import uuid
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional, List
+from typing import Dict, NamedTuple, Optional, List, Set
 
 from pygls.server import LanguageServer
 from pygls.workspace import utf16_num_units
 
 from lsprotocol.types import (
     INITIALIZED,
+    SHUTDOWN,
     TEXT_DOCUMENT_CODE_ACTION,
     TEXT_DOCUMENT_DID_CHANGE,
     TEXT_DOCUMENT_DID_CLOSE,
     TEXT_DOCUMENT_DID_SAVE,
+    WINDOW_WORK_DONE_PROGRESS_CANCEL,
 )
 from lsprotocol.types import (
     CodeAction,
@@ -55,20 +69,16 @@ from lsprotocol.types import (
     TextEdit,
     VersionedTextDocumentIdentifier,
     WorkDoneProgressBegin,
+    WorkDoneProgressCancelParams,
     WorkDoneProgressEnd,
     WorkDoneProgressReport,
     WorkspaceConfigurationParams,
     WorkspaceEdit,
 )
 
-# Extend lsprotocol.types Range:
-def range_in(a: Range, b: Range):  # pylint: disable=invalid-name
-    """Check whether Range b is included in Range a."""
-    if (a.start <= b.start) & (b.end <= a.end):
-        return True
-    else:
-        return False
-Range.__contains__ = range_in
+from ._planning import (MatchCache, in_ranges, merge_diagnostics,
+                        plan_spellcheck)
+from ._pool import WorkerPool
 
 # The following mapping table is based on
 #    https://github.com/mfbehrens99/linter-yalafi/blob/e69af00/lib/linter-yalafi.js
@@ -108,7 +118,32 @@ LT_SEVERITY_MAPPING = {
 PLAIN_TEXT = 'plain_text'
 REPLACEMENTS = 'replacements'
 
-json_decoder = json.JSONDecoder()
+# Maximal number of quick fixes offered for each diagnostic
+MAX_REPLACEMENTS = 10
+
+# Maximal number of quick fixes offered at once, for instance when the
+# requested range contains many diagnostics
+MAX_CODE_ACTIONS = 100
+
+# Delay in seconds before the spellcheck starts after saving
+SAVE_DELAY = 0.3
+
+# Delay in seconds before shifted diagnostics are published
+PUBLISH_DELAY = 0.02
+
+# Minimal time in seconds between two publications of shifted diagnostics
+PUBLISH_INTERVAL = 0.1
+
+# The configuration file which YaLafi reads from its working directory
+CONFIG_FILE = '.yalafi.shell'
+
+# Options of YaLafi whose values are files read by YaLafi
+FILE_OPTIONS = ('--define', '--replace', '--add-modules')
+
+# Directory of the temporary files passed to YaLafi, which is kept in memory
+# on Linux. Otherwise, the default directory for temporary files is used.
+TEMP_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
 
 def json_get(dic, item, typ):
     """
@@ -129,35 +164,202 @@ def full_spellcheck(ls, text_document_uri):
     """
     Run YaLafi and populate diagnostics.
 
-    This is a simple implementation, which runs YaLafi on the full document as
-    a subprocess and maps the results to diagnostic entries.
+    YaLafi runs as a subprocess on a temporary copy of the document and the
+    results are mapped to diagnostic entries. If the document was checked
+    before with the same options, only paragraphs which changed since then
+    are kept in the copy and the diagnostics of all other paragraphs are
+    retained. An unchanged document is not checked at all. Paragraphs whose
+    results are found in `ls.match_cache` are not checked again either.
+
+    If the document changes while YaLafi runs, the diagnostics are not
+    replaced, such that the next save checks the changed paragraphs again.
+    Closed documents are neither checked nor published.
     """
+    if not _is_open(ls, text_document_uri):
+        return
     text_doc = ls.workspace.get_document(text_document_uri)
     ls.show_message_log(
         f"[Info] Spellcheck Document \"{text_doc.path}\""
     )
-    if text_doc.path:
-        token = str(uuid.uuid4())
-        ls.progress.create(token)
-        ls.progress.begin(token,
-            WorkDoneProgressBegin(title='Spellchecking', message='Run YaLafi')
+    if not text_doc.path:
+        return
+    version = text_doc.version
+    source = text_doc.source
+    context = _check_context(ls, text_doc)
+    plan = plan_spellcheck(ls.match_cache,
+                           _last_checked_source(ls, text_doc.uri, context),
+                           source, context)
+    if plan.changed is not None and len(plan.changed) == 0:
+        ls.show_message_log('[Info] No paragraph changed')
+        ls.publish_diagnostics(text_doc.uri, text_doc.diagnostics)
+        return
+    token = str(uuid.uuid4())
+    ls.progress.create(token)
+    ls.progress.begin(token,
+        WorkDoneProgressBegin(title='Spellchecking', message='Run YaLafi',
+                              cancellable=True)
+    )
+    old_diagnostics = getattr(text_doc, 'diagnostics', [])
+    lines = _line_index(source)
+
+    def publish_partial(matches):
+        if text_doc.version == version and _is_open(ls, text_doc.uri):
+            ls.publish_diagnostics(text_doc.uri, _collect_diagnostics(
+                old_diagnostics, plan, matches, lines
+            ))
+
+    matches = _check_jobs(ls, token, text_doc, plan, publish_partial)
+    if matches is None:
+        return
+    ls.progress.report(token,
+        WorkDoneProgressReport(message='Create Diagnostics'),
+    )
+    diagnostics = _collect_diagnostics(old_diagnostics, plan, matches, lines)
+    with ls.diagnostics_lock:
+        # `did_change` shifts the diagnostics after the version changed
+        # and `did_close` drops the document after it was removed.
+        if not _is_open(ls, text_doc.uri):
+            result = 'Closed'
+        elif text_doc.version != version:
+            result = 'Outdated'
+        else:
+            result = 'Finished'
+            text_doc.diagnostics = diagnostics
+            ls.last_checked[text_doc.uri] = (context, source)
+    if result == 'Closed':
+        ls.show_message_log('[Info] Document closed during spellcheck')
+    elif result == 'Outdated':
+        ls.show_message_log('[Info] Document changed during spellcheck')
+    else:
+        ls.publish_diagnostics(text_doc.uri, text_doc.diagnostics)
+    ls.progress.end(token, WorkDoneProgressEnd(message=result))
+
+
+def _check_context(ls, text_doc):
+    """
+    Return the options, the working directory and the state of the files
+    read by YaLafi, which the results of a spellcheck depend on.
+    """
+    cwd = Path(text_doc.path).parent
+    return (tuple(ls.yalafi_options), str(cwd),
+            _config_files_state(ls.yalafi_options, cwd))
+
+
+def _last_checked_source(ls, uri, context):
+    """Return the source of `uri` checked last in `context` or None."""
+    old_context, old_source = ls.last_checked.get(uri, (None, None))
+    return old_source if old_context == context else None
+
+
+def _check_jobs(ls, token, text_doc, plan, publish_partial):
+    """
+    Run YaLafi on the jobs of `plan` and cache the matches found.
+
+    While other jobs still run, `publish_partial` is called with the matches
+    found so far. Returns all matches of the document or None if YaLafi
+    failed.
+    """
+    matches = list(plan.matches)
+    if not plan.jobs:
+        ls.show_message_log('[Info] All paragraphs found in cache')
+        return matches
+    remaining = len(plan.jobs)
+
+    def add_result(index, dic):
+        nonlocal remaining
+        checked = plan.jobs[index][1]
+        matches.extend(
+            match for match in json_get(dic, 'matches', list)
+            if in_ranges(match['offset'], checked)
         )
-        success = False
+        remaining -= 1
+        if remaining > 0:
+            # Show the results of finished jobs while others run.
+            publish_partial(matches)
+
+    if not _spellcheck_sources(ls, token, text_doc,
+                               [job[0] for job in plan.jobs], add_result):
+        return None
+    ls.match_cache.store(matches[len(plan.matches):], plan.pending)
+    return matches
+
+
+def _is_open(ls, uri):
+    return uri in ls.workspace.documents
+
+
+def _config_files_state(options, cwd):
+    """
+    Return the modification times and sizes of the files read by YaLafi.
+
+    These are `CONFIG_FILE` in `cwd` and the files given to the options in
+    `FILE_OPTIONS`, either in `options` or in `CONFIG_FILE`. The state of a
+    missing file is None.
+    """
+    config = cwd / CONFIG_FILE
+    args = list(options)
+    if '--no-config' not in args:
         try:
-            result = subprocess.run(
-                [sys.executable] +
-                ['-m', 'yalafi.shell', '--out', 'json'] +
-                ls.yalafi_options +
-                [text_doc.path],
-                cwd=Path(text_doc.path).parent, capture_output=True,
-                encoding='UTF-8', check=True
-                )
-            ls.progress.report(token,
-                WorkDoneProgressReport(message='Parse result'),
-            )
-            dic = json_decoder.decode(result.stdout)
-            success = True
-        except subprocess.CalledProcessError as exception:
+            lines = config.read_text(encoding='UTF-8').splitlines()
+        except (OSError, UnicodeDecodeError):
+            lines = []
+        # YaLafi splits each line only once, as the value may contain spaces.
+        args = [arg for line in lines
+                for arg in line.strip().split(maxsplit=1)] + args
+    paths = [config]
+    for option, value in zip(args, args[1:]):
+        if option in FILE_OPTIONS:
+            paths.append(cwd / value)
+    paths.extend(cwd / arg.split('=', 1)[1] for arg in args
+                 if arg.split('=', 1)[0] in FILE_OPTIONS and '=' in arg)
+    state = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            state.append((str(path), stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            state.append((str(path), None))
+    return tuple(state)
+
+
+def _spellcheck_sources(ls, token, text_doc, sources, add_result):
+    """
+    Run YaLafi on all `sources` in parallel, which are copies of `text_doc`.
+
+    As soon as YaLafi finished on a source, `add_result` is called with the
+    index of the source and the parsed output. Errors are logged and False is
+    returned. In this case, the progress `token` is ended.
+    """
+    success = False
+    cwd = Path(text_doc.path).parent
+    entry = ls.yalafi_pool.register(token, text_doc.uri)
+    try:
+        with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            futures = {
+                executor.submit(_spellcheck_source, ls, token, source, cwd):
+                index
+                for index, source in enumerate(sources)
+            }
+            for future in as_completed(futures):
+                stdout, stderr = future.result()
+                try:
+                    result = json.loads(stdout)
+                except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                    ls.show_message_log(
+                        '[Error] YaLafi did not returned valid JSON.'
+                    )
+                    ls.show_message_log(
+                        "[Error] YaLafi Stderr:\n    " +
+                        str(stderr).replace('\n', '\n    ')
+                    )
+                    break
+                add_result(futures[future], result)
+            else:
+                success = True
+    except subprocess.CalledProcessError as exception:
+        if entry.cancelled:
+            ls.show_message_log('[Info] Spellcheck cancelled')
+        else:
             ls.show_message_log(
                 "[Error] Could not run Yalafi. " +
                 "Maybe the command line options are not correctly set."
@@ -169,62 +371,98 @@ def full_spellcheck(ls, text_document_uri):
             )
             ls.show_message_log(
                 "[Error] Stderr:\n    " +
-                "\n    ".join(str(exception.stderr).split('\n'))
-            )
-        except FileNotFoundError as exception:
-            ls.show_message_log(
-                "[Error] Could not run Yalafi because " +
-                exception.filename +
-                " was not found."
+                str(exception.stderr).replace('\n', '\n    ')
             )
-        except json.decoder.JSONDecodeError:
-            ls.show_message_log('[Error] YaLafi did not returned valid JSON.')
-            ls.show_message_log(
-                "[Error] YaLafi Stderr:\n    " +
-                "\n    ".join(str(result.stderr).split('\n'))
-            )
-        finally:
-            if not success:
-                ls.show_message(
-                    'Could not run YaLafi. ' +
-                    'See YaLafi output for more information.',
-                    msg_type=MessageType.Error)
-                ls.progress.end(token, WorkDoneProgressEnd(message='Failed'))
-        if success:
-            ls.progress.report(token,
-                WorkDoneProgressReport(message='Create Diagnostics'),
-            )
-            matches = json_get(dic, 'matches', list)
-            diagnostics = []
-            for match in matches:
-                diagnostics.append(_create_diagnostic_from_match(match, text_doc))
-            text_doc.diagnostics = diagnostics
-            ls.publish_diagnostics(text_doc.uri, text_doc.diagnostics)
-            ls.progress.end(token, WorkDoneProgressEnd(message='Finished'))
-
-
-def _create_diagnostic_from_match(match, text_doc):
-    offset = json_get(match, 'offset', int) -1
-    length = json_get(match, 'length', int)
-    lt_message = json_get(match, 'message', str)
-    lt_short_message = json_get(match, 'shortMessage', str)
-    lt_rule = json_get(match, 'rule', dict)
-    lt_replacements = json_get(match, 'replacements', list)
-    plain_text, context = _mark_context(json_get(match, 'context', dict))
+    except FileNotFoundError as exception:
+        ls.show_message_log(
+            "[Error] Could not run Yalafi because " +
+            exception.filename +
+            " was not found."
+        )
+    finally:
+        ls.yalafi_pool.unregister(token)
+        if entry.cancelled:
+            ls.progress.end(token, WorkDoneProgressEnd(message='Cancelled'))
+        elif not success:
+            ls.show_message(
+                'Could not run YaLafi. ' +
+                'See YaLafi output for more information.',
+                msg_type=MessageType.Error)
+            ls.progress.end(token, WorkDoneProgressEnd(message='Failed'))
+    return success
+
+
+def _spellcheck_source(ls, token, source, cwd):
+    """
+    Run YaLafi on a temporary file containing `source`.
+
+    YaLafi can only read files, so the text of the editor is written to a
+    file in `TEMP_DIR`.
+    """
+    with tempfile.NamedTemporaryFile(mode='w', encoding='UTF-8',
+                                     suffix='.tex', dir=TEMP_DIR,
+                                     delete=False) as file:
+        file.write(source)
+    try:
+        return ls.yalafi_pool.run(
+            token,
+            ['--out', 'json'] + ls.yalafi_options + [file.name],
+            cwd
+        )
+    finally:
+        os.remove(file.name)
+
+
+def _collect_diagnostics(old_diagnostics, plan, matches, lines):
+    """Create the diagnostics of `matches` and keep those not rechecked."""
+    diagnostics = _create_diagnostics(matches, lines)
+    if plan.changed is not None:
+        diagnostics = merge_diagnostics(old_diagnostics, diagnostics,
+                                        plan.changed)
+    return diagnostics
+
+
+# The fields of the matches are accessed directly, since YaLafi already
+# checked offset and length and LanguageTool always reports the others.
+_MATCH_OFFSET = operator.itemgetter('offset')
+_MATCH_FIELDS = operator.itemgetter('message', 'shortMessage', 'rule',
+                                    'replacements', 'context')
+
+def _create_diagnostics(matches, lines):
+    """
+    Create diagnostics from the matches reported by YaLafi.
+
+    The positions of all matches are computed first and in increasing order,
+    such that the search for each line can start at the previous one. The
+    diagnostics are sorted by their start.
+    """
+    matches = sorted(matches, key=_MATCH_OFFSET)
+    ranges = []
+    line = 0
+    for match in matches:
+        offset = match['offset']
+        start = _position_from_offset(lines, offset, line)
+        line = start.line
+        end = _position_from_offset(lines, offset + match['length'], line)
+        ranges.append(Range(start=start, end=end))
+    return [
+        _create_diagnostic_from_match(match, match_range)
+        for match, match_range in zip(matches, ranges)
+    ]
+
+
+def _create_diagnostic_from_match(match, match_range):
+    (lt_message, lt_short_message, lt_rule, lt_replacements,
+     lt_context) = _MATCH_FIELDS(match)
+    plain_text, context = _mark_context(lt_context)
     message = f"{lt_short_message}\n{lt_message}\nContext: {context}"
-    if lt_rule['category']['id'] in LT_SEVERITY_MAPPING.keys():
-        severity = LT_SEVERITY_MAPPING[lt_rule['category']['id']]
-    else:
-        severity = DiagnosticSeverity.Error
+    severity = LT_SEVERITY_MAPPING.get(lt_rule['category']['id'],
+                                       DiagnosticSeverity.Error)
     return Diagnostic(
-        range=Range(
-            start=_position_from_offset(text_doc.source,
-                                       text_doc.lines, offset),
-            end=_position_from_offset(text_doc.source,
-                                     text_doc.lines, offset + length)
-        ),
+        range=match_range,
         message=message,
-        code=lt_rule['id'].lower(),
+        # Many diagnostics share a few rules, so share their codes, too.
+        code=sys.intern(lt_rule['id'].lower()),
         severity=severity,
         data={PLAIN_TEXT: plain_text, REPLACEMENTS: lt_replacements[:10]},
         source=SERVER.SOURCE_NAME
@@ -246,46 +484,193 @@ def _mark_context(context: dict):
     """
     text = context['text']
     offset = context['offset']
-    length = context['length']
-    plain_text = text[offset:offset+length]
-    marked_context = text[:offset] + '>>>' + plain_text + '<<<' \
-                     + text[offset+length:]
+    end = offset + context['length']
+    plain_text = text[offset:end]
+    marked_context = ''.join((text[:offset], '>>>', plain_text, '<<<',
+                              text[end:]))
     return plain_text, marked_context
 
 
-def _position_from_offset(tex, lines, offset):
-    lin = tex.count('\n', 0, offset)
-    col = offset - tex.rfind('\n', 0, offset)
-    position = Position(line=lin, character=col)
-    return position
+def _line_starts(tex):
+    """Return the offsets of the beginnings of all lines in `tex`."""
+    return [0, *itertools.accumulate(len(line) + 1
+                                     for line in tex.split('\n')[:-1])]
+
+
+# Characters outside of the BMP, which take two UTF-16 code units
+_ASTRAL = re.compile('[\U00010000-\U0010ffff]')
+
+class _LineIndex(NamedTuple):
+    """
+    The line starts of `source` and the lines containing characters outside
+    of the BMP.
+
+    LSP positions count UTF-16 code units, which only differ from the
+    offsets in Python strings on the lines in `astral`.
+    """
+    source: str
+    starts: List[int]
+    astral: Set[int]
+
+
+def _line_index(tex):
+    starts = _line_starts(tex)
+    astral = set()
+    if not tex.isascii():
+        astral = {bisect.bisect_right(starts, m.start()) - 1
+                  for m in _ASTRAL.finditer(tex)}
+    return _LineIndex(tex, starts, astral)
+
+
+def _position_from_offset(lines, offset, first_line=0):
+    lin = bisect.bisect_right(lines.starts, offset, first_line) - 1
+    col = offset - lines.starts[lin]
+    if lin in lines.astral:
+        col = utf16_num_units(lines.source[lines.starts[lin]:offset])
+    return Position(line=lin, character=col)
+
+
+def _offset_from_position(lines, position):
+    """Return the offset of `position` or None if it is not in the text."""
+    if position.line >= len(lines.starts):
+        return None
+    start = lines.starts[position.line]
+    if position.line not in lines.astral:
+        return start + position.character
+    units = 0
+    offset = start
+    while units < position.character:
+        if offset >= len(lines.source) or lines.source[offset] == '\n':
+            return None
+        units += 2 if ord(lines.source[offset]) > 0xFFFF else 1
+        offset += 1
+    return offset
 
 
 def shift_diagnostics(diagnostics: List[Diagnostic],
-                      change: TextDocumentContentChangeEvent) -> None:
-    """Shift all diagnostics according to the changes."""
+                      change: TextDocumentContentChangeEvent
+                      ) -> List[Diagnostic]:
+    """
+    Shift all diagnostics according to the change.
+
+    Diagnostics within the changed range are dropped and diagnostics which
+    overlap it are shortened. The diagnostics have to be sorted by their
+    start and their positions are changed in place. Returns the list of
+    remaining diagnostics or, if no diagnostic is affected by the change,
+    `diagnostics` itself.
+    """
     if len(diagnostics) == 0:
-        return
+        return diagnostics
+    if getattr(change, 'range', None) is None:
+        # The whole document was replaced.
+        return []
+    line_diff, character_diff = _position_shift(change)
+    # Positions are compared as tuples, which is faster than comparing
+    # Positions.
+    start_key = (change.range.start.line, change.range.start.character)
+    end_key = (change.range.end.line, change.range.end.character)
+
+    def shift(position):
+        """Move a position behind the changed range in place."""
+        if position.line == end_key[0]:
+            position.character += character_diff
+        position.line += line_diff
+
+    shifted = []
+    affected = False
+    for index, d in enumerate(diagnostics):  # pylint: disable=invalid-name
+        d_start, d_end = d.range.start, d.range.end
+        d_start_key = (d_start.line, d_start.character)
+        d_end_key = (d_end.line, d_end.character)
+        if d_end_key <= start_key:
+            shifted.append(d)
+            continue
+        if line_diff == 0 and d_start.line > end_key[0]:
+            # The diagnostics are sorted by their start, so none of the
+            # remaining diagnostics moves.
+            shifted.extend(diagnostics[index:])
+            break
+        affected = True
+        if end_key <= d_start_key:
+            shift(d_start)
+            shift(d_end)
+        elif start_key <= d_start_key and d_end_key <= end_key:
+            continue
+        elif d_start_key < start_key:
+            if end_key <= d_end_key:
+                shift(d_end)
+            else:
+                d.range.end = Position(line=start_key[0],
+                                       character=start_key[1])
+        else:
+            d.range.start = Position(line=end_key[0],
+                                     character=end_key[1])
+            shift(d.range.start)
+            shift(d_end)
+        shifted.append(d)
+    return shifted if affected else diagnostics
+
+
+def _position_shift(change):
+    """
+    Return the numbers of lines and of characters by which positions behind
+    the range of `change` move. The characters only move on the last line of
+    the range.
+    """
     change_start = change.range.start
     change_end = change.range.end
     change_rows = change.text.count("\n")
-    change_single_line = False
-    if (change_start.line == change_end.line) & (change_rows == 0):
-        change_single_line = True
-    change_length = utf16_num_units(change.text)
     change_line_diff = change_start.line - change_end.line + change_rows
-    change_character_diff = change_start.character - change_end.character + change_length
-    for d in diagnostics:  # pylint: disable=invalid-name
-        if d.range.end < change_start:
-            continue
-        elif d.range.start.line > change_end.line:
-            d.range.start.line += change_line_diff
-            d.range.end.line += change_line_diff
-        elif (change_start <= d.range.start) & (d.range.end <= change_end):
-            diagnostics.remove(d)
-        elif change_single_line & (d.range.start.line == change_start.line):
-            if change_end.character <= d.range.start.character:
-                d.range.start.character += change_character_diff
-                d.range.end.character += change_character_diff
+    if change_rows == 0:
+        change_character_diff = (change_start.character
+                                 - change_end.character
+                                 + utf16_num_units(change.text))
+    else:
+        change_character_diff = (
+            utf16_num_units(change.text[change.text.rfind("\n")+1:])
+            - change_end.character
+        )
+    return change_line_diff, change_character_diff
+
+
+@dataclass
+class _SpellcheckState:
+    """
+    The spellchecks run by `did_save`.
+
+    executor: Runs the spellchecks.
+    scheduled: The tasks of `did_save` waiting for the start of a
+        spellcheck by uri.
+    running: The uris of running spellchecks.
+    dirty: The uris of running spellchecks which run once more after they
+        finished.
+    lock: Guards `running` and `dirty`.
+    """
+    executor: ThreadPoolExecutor = field(
+        default_factory=lambda: ThreadPoolExecutor(
+            thread_name_prefix='spellcheck'
+        )
+    )
+    scheduled: Dict[str, asyncio.Task] = field(default_factory=dict)
+    running: Set[str] = field(default_factory=set)
+    dirty: Set[str] = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+@dataclass
+class _PublishState:
+    """
+    The publications of diagnostics.
+
+    pending: The timers of scheduled publications by uri.
+    last: The time of the last scheduled publication by uri.
+    nonempty: The uris whose last published diagnostics were not empty.
+    lock: Guards `pending` and `last`.
+    """
+    pending: Dict[str, threading.Timer] = field(default_factory=dict)
+    last: Dict[str, float] = field(default_factory=dict)
+    nonempty: Set[str] = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
 
 
 class YaLafiLanguageServer(LanguageServer):
@@ -298,30 +683,53 @@ class YaLafiLanguageServer(LanguageServer):
     def __init__(self,**kwargs):
         super().__init__(**kwargs)
         self.yalafi_options = []
+        self.last_checked = {}
+        self.diagnostics_lock = threading.Lock()
+        self.match_cache = MatchCache()
+        self.yalafi_pool = WorkerPool()
+        self.spellchecks = _SpellcheckState()
+        self.publishing = _PublishState()
+
+    def publish_diagnostics(self, uri, diagnostics=None, version=None,
+                            **kwargs):
+        """
+        Publish the diagnostics of `uri` unless both these and the ones
+        published last are empty.
+        """
+        if diagnostics:
+            self.publishing.nonempty.add(uri)
+        elif uri in self.publishing.nonempty:
+            self.publishing.nonempty.discard(uri)
+        else:
+            return
+        super().publish_diagnostics(uri, diagnostics, version, **kwargs)
 
 
 SERVER = YaLafiLanguageServer(name="yalafi-language-server",
                               version="0.0.1")
 
 
-def fetch_configuration(ls):
+async def fetch_configuration(ls):
     """
     Fetch configuration from client.
     """
     try:
         ls.show_message_log('[Info] Fetching configuration')
-        config = ls.get_configuration(WorkspaceConfigurationParams(items=[
-            ConfigurationItem(
-                scope_uri='',
-                section='yalafi')
-        ])).result(3)
+        config = await asyncio.wait_for(
+            ls.get_configuration_async(WorkspaceConfigurationParams(items=[
+                ConfigurationItem(
+                    scope_uri='',
+                    section='yalafi')
+            ])),
+            3
+        )
 
         ls.show_message_log('[Info] Fetched configuration')
         ls.yalafi_options = config[0].get('commandLineOptions')
     except Exception as exception:
         ls.show_message_log(
             '[Warning] Could not fetch configuration\n    ' +
-            "\n    ".join(str(exception).split('\n'))
+            str(exception).replace('\n', '\n    ')
         )
 
 
@@ -330,6 +738,9 @@ def fetch_configuration(ls):
 def initiliazed(ls: YaLafiLanguageServer, _params: InitializedParams) -> None:
     """Connection is initialized."""
     ls.show_message_log('[Info] Initialized')
+    # Start a worker in advance, such that YaLafi is ready for the first
+    # spellcheck.
+    ls.yalafi_pool.release(ls.yalafi_pool.acquire())
 
 
 @SERVER.thread()
@@ -353,71 +764,227 @@ def code_action(ls, params: CodeActionParams) -> Optional[List[CodeAction]]:
     document_identifier = VersionedTextDocumentIdentifier(uri=uri,
                                                           version=version)
 
+    source = document.source
+    lines = _line_index(source)
+    code_actions = []
+    diagnostics = (diag for diag in params.context.diagnostics
+                   if diag.source == SERVER.SOURCE_NAME
+                   and diag.data is not None)
+    for diag in diagnostics:
+        if len(code_actions) >= MAX_CODE_ACTIONS:
+            break
+        replacements = diag.data[REPLACEMENTS]
+        if replacements:
+            offset_beg = _offset_from_position(lines, diag.range.start)
+            offset_end = _offset_from_position(lines, diag.range.end)
+            plain_text = diag.data[PLAIN_TEXT]
+            if (offset_beg is None or offset_end is None
+                    or offset_end - offset_beg != len(plain_text)
+                    or not source.startswith(plain_text, offset_beg)):
+                continue
+            code_actions.extend(_quick_fixes(diag, replacements,
+                                             document_identifier))
+    return code_actions
+
+
+def _quick_fixes(diag, replacements, document_identifier):
+    """Return quick fixes for the first `MAX_REPLACEMENTS` replacements."""
     code_actions = []
-    for diag in params.context.diagnostics:
-        if ( diag.source == SERVER.SOURCE_NAME
-             and diag.data[REPLACEMENTS] is not None
-             and len(diag.data[REPLACEMENTS]) > 0 ):
-            offset_beg = document.offset_at_position(diag.range.start)
-            offset_end = document.offset_at_position(diag.range.end)
-            if document.source[offset_beg:offset_end] != diag.data[PLAIN_TEXT]:
-                break
-            for repl in diag.data[REPLACEMENTS]:
-                title = repl['value']
-                if 'shortDescription' in repl.keys():
-                    title += ' (' + repl['shortDescription'] + ')'
-                code_actions.append(
-                    CodeAction(
-                        title=title,
-                        diagnostics=[diag],
-                        kind=CodeActionKind.QuickFix,
-                        edit=WorkspaceEdit(
-                            document_changes=[
-                                TextDocumentEdit(
-                                    text_document=document_identifier,
-                                    edits=[
-                                        TextEdit(
-                                        range=diag.range,
-                                        new_text=repl['value']
-                                        )
-                                    ]
+    for repl in itertools.islice(replacements, MAX_REPLACEMENTS):
+        title = repl['value']
+        if 'shortDescription' in repl:
+            title += ' (' + repl['shortDescription'] + ')'
+        code_actions.append(
+            CodeAction(
+                title=title,
+                diagnostics=[diag],
+                kind=CodeActionKind.QuickFix,
+                edit=WorkspaceEdit(
+                    document_changes=[
+                        TextDocumentEdit(
+                            text_document=document_identifier,
+                            edits=[
+                                TextEdit(
+                                    range=diag.range,
+                                    new_text=repl['value']
                                 )
                             ]
                         )
-                        )
+                    ]
                 )
-                if len(code_actions)>10:
-                    break
+            )
+        )
     return code_actions
 
 
-def _update_diagnostics(ls, params):
+def _update_diagnostics(ls, text_doc, params):
+    """Shift the diagnostics and return whether any of them changed."""
     ls.show_message_log('[Info] Updating diagnostics')
 
-    text_doc = ls.workspace.get_document(params.text_document.uri)
-    for change in params.content_changes:
-        shift_diagnostics(text_doc.diagnostics, change)
+    with ls.diagnostics_lock:
+        old_diagnostics = getattr(text_doc, 'diagnostics', [])
+        diagnostics = old_diagnostics
+        for change in params.content_changes:
+            if getattr(change, 'range', None) is None:
+                # All diagnostics are dropped, so check the full document.
+                ls.last_checked.pop(text_doc.uri, None)
+            diagnostics = shift_diagnostics(diagnostics, change)
+        text_doc.diagnostics = diagnostics
+    return diagnostics is not old_diagnostics
+
+
+def _schedule_publish(ls, uri):
+    """
+    Publish the diagnostics of `uri` after `PUBLISH_DELAY` seconds.
+
+    If a publication is still pending for `uri`, nothing is scheduled, since
+    it publishes the diagnostics at that time. Thus, bursts of changes result
+    in a single publication. Moreover, publications of `uri` are at least
+    `PUBLISH_INTERVAL` seconds apart.
+    """
+    with ls.publishing.lock:
+        if uri in ls.publishing.pending:
+            return
+        delay = max(PUBLISH_DELAY,
+                    ls.publishing.last.get(uri, -math.inf) + PUBLISH_INTERVAL
+                    - time.monotonic())
+        timer = threading.Timer(delay, _publish_scheduled, (ls, uri))
+        ls.publishing.pending[uri] = timer
+        timer.start()
+
+
+def _publish_scheduled(ls, uri):
+    with ls.publishing.lock:
+        if ls.publishing.pending.get(uri) is threading.current_thread():
+            del ls.publishing.pending[uri]
+        ls.publishing.last[uri] = time.monotonic()
+    text_doc = ls.workspace.get_document(uri)
+    ls.publish_diagnostics(uri, text_doc.diagnostics)
+
+
+def _cancel_publish(ls, uri):
+    """Cancel a pending publication and return whether there was one."""
+    with ls.publishing.lock:
+        timer = ls.publishing.pending.pop(uri, None)
+    if timer is None:
+        return False
+    timer.cancel()
+    return True
 
 
 @SERVER.feature(TEXT_DOCUMENT_DID_CHANGE)
 def did_change(ls, params: DidChangeTextDocumentParams):
     """Move diagnostics after changing the document."""
     text_doc = ls.workspace.get_document(params.text_document.uri)
-    _update_diagnostics(ls, params)
-    ls.publish_diagnostics(text_doc.uri, text_doc.diagnostics)
+    if _update_diagnostics(ls, text_doc, params):
+        _schedule_publish(ls, text_doc.uri)
 
 
-@SERVER.thread()
 @SERVER.feature(TEXT_DOCUMENT_DID_SAVE)
-def did_save(ls, params: DidSaveTextDocumentParams):
-    """Spellcheck the document after saving the document."""
-    fetch_configuration(ls)
-    full_spellcheck(ls, params.text_document.uri)
+async def did_save(ls, params: DidSaveTextDocumentParams):
+    """
+    Spellcheck the document after saving the document.
+
+    The spellcheck starts `SAVE_DELAY` seconds after the last of several
+    saves in quick succession. A spellcheck of the same document which is
+    still running is cancelled.
+
+    The spellcheck runs in a thread of its own, such that it does not occupy
+    the few threads which pygls uses for other requests like code actions.
+    """
+    uri = params.text_document.uri
+    if _cancel_publish(ls, uri):
+        ls.publish_diagnostics(uri, ls.workspace.get_document(uri).diagnostics)
+    task = asyncio.current_task()
+    previous_task = ls.spellchecks.scheduled.get(uri)
+    ls.spellchecks.scheduled[uri] = task
+    if previous_task is not None:
+        previous_task.cancel()
+    if ls.yalafi_pool.cancel_document(uri):
+        ls.show_message_log('[Info] Cancel spellcheck')
+    try:
+        await asyncio.sleep(SAVE_DELAY)
+        await fetch_configuration(ls)
+    except asyncio.CancelledError:
+        return
+    finally:
+        if ls.spellchecks.scheduled.get(uri) is task:
+            del ls.spellchecks.scheduled[uri]
+    await asyncio.get_running_loop().run_in_executor(
+        ls.spellchecks.executor, _run_spellcheck, ls, uri
+    )
+
+
+def _run_spellcheck(ls, uri):
+    """
+    Run `full_spellcheck` unless a spellcheck of `uri` is already running.
+
+    In that case, the running spellcheck checks the document once more after
+    it finished, such that overlapping saves do not occupy several threads.
+    """
+    with ls.spellchecks.lock:
+        if uri in ls.spellchecks.running:
+            ls.spellchecks.dirty.add(uri)
+            return
+        ls.spellchecks.running.add(uri)
+    try:
+        while True:
+            full_spellcheck(ls, uri)
+            with ls.spellchecks.lock:
+                if uri not in ls.spellchecks.dirty:
+                    ls.spellchecks.running.discard(uri)
+                    return
+                ls.spellchecks.dirty.discard(uri)
+    except BaseException:
+        with ls.spellchecks.lock:
+            ls.spellchecks.running.discard(uri)
+            ls.spellchecks.dirty.discard(uri)
+        raise
+
+
+@SERVER.feature(WINDOW_WORK_DONE_PROGRESS_CANCEL)
+def progress_cancel(ls: YaLafiLanguageServer,
+                    params: WorkDoneProgressCancelParams):
+    """Stop YaLafi if the spellcheck is cancelled."""
+    if ls.yalafi_pool.cancel(params.token):
+        ls.show_message_log('[Info] Cancel spellcheck')
 
 
 @SERVER.thread()
 @SERVER.feature(TEXT_DOCUMENT_DID_CLOSE)
 def did_close(ls: YaLafiLanguageServer, params: DidCloseTextDocumentParams):
-    """Delete Diagnostics after closing the document."""
-    text_doc = ls.workspace.get_document(params.text_document.uri)
-    ls.publish_diagnostics(text_doc.uri, [])
+    """
+    Delete Diagnostics after closing the document.
+
+    Scheduled and running spellchecks of the document are cancelled.
+    """
+    uri = params.text_document.uri
+    task = ls.spellchecks.scheduled.pop(uri, None)
+    if task is not None:
+        # This handler runs in a thread, the task in the event loop.
+        ls.loop.call_soon_threadsafe(task.cancel)
+    if ls.yalafi_pool.cancel_document(uri):
+        ls.show_message_log('[Info] Cancel spellcheck')
+    _cancel_publish(ls, uri)
+    with ls.publishing.lock:
+        ls.publishing.last.pop(uri, None)
+    with ls.spellchecks.lock:
+        ls.spellchecks.dirty.discard(uri)
+    with ls.diagnostics_lock:
+        ls.last_checked.pop(uri, None)
+    ls.publish_diagnostics(uri, [])
+
+
+@SERVER.feature(SHUTDOWN)
+def shutdown(ls: YaLafiLanguageServer, *_args):
+    """
+    Cancel all spellchecks and stop the YaLafi workers.
+
+    This runs before the reply to the shutdown request is sent, such that no
+    worker outlives the server.
+    """
+    for task in ls.spellchecks.scheduled.values():
+        task.cancel()
+    ls.spellchecks.scheduled.clear()
+    ls.yalafi_pool.shutdown()
+    ls.spellchecks.executor.shutdown(cancel_futures=True)